@@ -0,0 +1,29 @@
+# cython: boundscheck=False, wraparound=False, language_level=3
+"""
+Optional C kernel for the nearest-color + nibble-pack hot loop.
+
+Build in place with:  python setup.py build_ext --inplace
+app.py falls back to the NumPy LUT path when the extension is absent.
+"""
+
+def pack(const unsigned char[:, :, ::1] rgb, const unsigned char[::1] lut,
+         unsigned char[:, ::1] out):
+    """Map RGB pixels through the 15-bit palette LUT and pack nibble pairs
+
+    rgb is (H, W, 3) uint8 with W even, lut the 32768-entry palette LUT,
+    out the preallocated (H, W/2) uint8 destination.
+    """
+    cdef Py_ssize_t height = rgb.shape[0]
+    cdef Py_ssize_t width = rgb.shape[1]
+    cdef Py_ssize_t y, x
+    cdef unsigned int key1, key2
+
+    for y in range(height):
+        for x in range(0, width, 2):
+            key1 = (((rgb[y, x, 0] & 0xF8) << 7)
+                    | ((rgb[y, x, 1] & 0xF8) << 2)
+                    | (rgb[y, x, 2] >> 3))
+            key2 = (((rgb[y, x + 1, 0] & 0xF8) << 7)
+                    | ((rgb[y, x + 1, 1] & 0xF8) << 2)
+                    | (rgb[y, x + 1, 2] >> 3))
+            out[y, x >> 1] = (lut[key1] << 4) | lut[key2]
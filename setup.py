@@ -0,0 +1,10 @@
+"""Builds the optional epd_pack C extension (python setup.py build_ext --inplace)"""
+from setuptools import setup
+
+try:
+    from Cython.Build import cythonize
+    ext_modules = cythonize('epd_pack.pyx')
+except ImportError:
+    ext_modules = []
+
+setup(name='eframe-epd-pack', ext_modules=ext_modules)